@@ -66,8 +66,10 @@ class SurfaceReflectance():
         # command line
         if xml_infile == None:
             # Get version number
-            cmdstr = ('lasrc --version')
-            (exit_code, self.version) = subprocess.getstatusoutput(cmdstr)
+            result = subprocess.run(['lasrc', '--version'],
+                                    capture_output=True, text=True,
+                                    check=False)
+            self.version = result.stdout.strip()
 
             # get the command line argument for the XML file
             parser = OptionParser(version = self.version)
@@ -159,25 +161,24 @@ class SurfaceReflectance():
 
         # run surface reflectance algorithm, checking the return status.  exit
         # if any errors occur.
-        process_sr_opt_str = '--process_sr=true '
-        write_toa_opt_str = ''
-        use_orig_aero_alg_str = ''
-
+        cmd = ['lasrc', '--xml={}'.format(xml_infile),
+               '--aux={}'.format(aux_file)]
         if process_sr == 'False':
-            process_sr_opt_str = '--process_sr=false '
+            cmd.append('--process_sr=false')
+        else:
+            cmd.append('--process_sr=true')
         if write_toa:
-            write_toa_opt_str = '--write_toa '
+            cmd.append('--write_toa')
         if use_orig_aero_alg:
-            use_orig_aero_alg_str = '--use_orig_aero_alg '
-
-        cmdstr = ('lasrc --xml={} --aux={} {}{}--verbose'
-                  .format(xml_infile, aux_file, process_sr_opt_str,
-                          write_toa_opt_str, use_orig_aero_alg_str))
-        msg = 'Executing lasrc command: {}'.format(cmdstr)
+            cmd.append('--use_orig_aero_alg')
+        cmd.append('--verbose')
+        msg = 'Executing lasrc command: {}'.format(' '.join(cmd))
         logger.debug (msg)
-        (exit_code, output) = subprocess.getstatusoutput (cmdstr)
-        logger.info (output)
-        if exit_code != 0:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, text=True,
+                                check=False)
+        logger.info (result.stdout)
+        if result.returncode != 0:
             msg = 'Error running lasrc.  Processing will terminate.'
             logger.error (msg)
             os.chdir (mydir)
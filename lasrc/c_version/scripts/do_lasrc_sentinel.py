@@ -2,14 +2,34 @@
 import sys
 import os
 import re
+import stat
 import subprocess
 import datetime
-from optparse import OptionParser
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import argparse
 import logging
 
 ERROR = 1
 SUCCESS = 0
 
+logger = logging.getLogger(__name__)
+
+# Sentinel-2 collection scene name prefixes
+S2_PREFIXES_COLLECTION = ('S2A_', 'S2B_', 'S2C_')
+
+
+#############################################################################
+# Description: _lasrc_version returns the version string reported by the
+# lasrc executable.  Running lasrc just to get the version is expensive, so
+# the result is cached and lasrc is only run once per interpreter.
+############################################################################
+@functools.lru_cache(maxsize=1)
+def _lasrc_version():
+    result = subprocess.run(['lasrc', '--version'], capture_output=True,
+                            text=True, check=False)
+    return result.stdout.strip()
+
 
 #############################################################################
 # Created on August 23, 2019 by Gail Schmidt, USGS/EROS
@@ -28,151 +48,275 @@ class SurfaceReflectance():
 
     ########################################################################
     # Description: runSr will use the parameters passed for the input and
-    # output files.  If input/output files are None (i.e. not specified) then
-    # the command-line parameters will be parsed for this information.  The
-    # surface reflectance application is then executed to generate the desired
-    # outputs on the specified input file.  If a log file was specified, then
-    # the output from this application will be logged to that file.
+    # output files.  The surface reflectance application is then executed to
+    # generate the desired outputs on the specified input file.  If a log
+    # file was specified, then the output from this application will be
+    # logged to that file.
     #
     # Inputs:
     #   xml_infile - name of the input XML file
-    #   process_sr - specifies whether the surface reflectance processing
-    #       should be completed.  True or False.  Default is True, otherwise
-    #       the processing will halt after the TOA reflectance products are
-    #       complete.
+    #   write_toa - specifies whether the intermediate TOA reflectance
+    #       products should be written.  True or False.  Default is False.
+    #   use_orig_aero_alg - specifies whether the historical aerosol
+    #       retrieval should be used.  True or False.  Default is False.
     #
     # Returns:
     #     ERROR - error running the surface reflectance application
     #     SUCCESS - successful processing
     #
     # Notes:
-    #   1. The script obtains the path of the XML file and changes
-    #      directory to that path for running the surface reflectance
-    #      application.  If the XML file directory is not writable, then this
-    #      script exits with an error.
-    #   2. If the XML file is not specified and the information is
-    #      going to be grabbed from the command line, then it's assumed all
-    #      the parameters will be pulled from the command line.
+    #   1. The script obtains the path of the XML file and runs the surface
+    #      reflectance application from that directory.  If the XML file
+    #      directory is not writable, then this script exits with an error.
+    #      The working directory of this script itself is not changed.
+    #   2. The command-line arguments are parsed by main(), which calls this
+    #      method with the resolved parameters.
     #######################################################################
     def runSr (
         self,
-        xml_infile=None,
+        xml_infile,
         write_toa=False,
         use_orig_aero_alg=False
     ):
-        # if no parameters were passed then get the info from the
-        # command line
-        if xml_infile == None:
-            # Get version number
-            cmdstr = ('lasrc --version')
-            (exit_code, self.version) = subprocess.getstatusoutput(cmdstr)
-
-            # get the command line argument for the XML file
-            parser = OptionParser(version = self.version)
-            parser.add_option ("-i", "--xml", type="string",
-                dest="xml",
-                help="name of XML file", metavar="FILE")
-            parser.add_option ("--write_toa", dest="write_toa", default=False,
-                action="store_true",
-                help="write the intermediate TOA reflectance products")
-            parser.add_option ("--use_orig_aero_alg", dest="use_orig_aero_alg", default=False,
-                action="store_true",
-                help="use historical aerosol retrieval")
-            (options, args) = parser.parse_args()
-    
-            # XML input file
-            xml_infile = options.xml
-            if xml_infile == None:
-                parser.error ('missing input XML file command-line argument');
-                return ERROR
-
-        # get the logger
-        logger = logging.getLogger(__name__)
-        msg = ('Surface reflectance processing of Sentinel-2 file: {}'
-               .format(xml_infile))
-        logger.info (msg)
+        logger.info ('Surface reflectance processing of Sentinel-2 file: %s',
+                     xml_infile)
         
         # make sure the XML file exists
-        if not os.path.isfile(xml_infile):
-            msg = ('XML file does not exist or is not accessible: {}'
-                   .format(xml_infile))
-            logger.error (msg)
+        try:
+            is_file = stat.S_ISREG(os.stat(xml_infile).st_mode)
+        except OSError:
+            is_file = False
+        if not is_file:
+            logger.error ('XML file does not exist or is not accessible: %s',
+                          xml_infile)
             return ERROR
 
-        # use the base XML filename and not the full path.
-        base_xmlfile = os.path.basename (xml_infile)
-        msg = 'Processing XML file: {}'.format(base_xmlfile)
-        logger.info (msg)
-        
-        # get the path of the XML file and change directory to that location
-        # for running this script.  save the current working directory for
-        # return to upon error or when processing is complete.  Note: use
-        # abspath to handle the case when the filepath is just the filename
-        # and doesn't really include a file path (i.e. the current working
-        # directory).
-        mydir = os.getcwd()
-        xmldir = os.path.dirname (os.path.abspath (xml_infile))
+        # get the path of the XML file and the base XML filename from the
+        # absolute path.  the surface reflectance application is run from
+        # that location using the base XML filename and not the full path.
+        # Note: use abspath to handle the case when the filepath is just the
+        # filename and doesn't really include a file path (i.e. the current
+        # working directory).
+        (xmldir, base_xmlfile) = os.path.split (os.path.abspath (xml_infile))
+        logger.info ('Processing XML file: %s', base_xmlfile)
+
         if not os.access(xmldir, os.W_OK):
-            msg = ('Path of XML file is not writable: {}. Script needs '
-                   'write access to the XML directory.'.format(xmldir))
-            logger.error (msg)
+            logger.error ('Path of XML file is not writable: %s. Script needs '
+                          'write access to the XML directory.', xmldir)
             return ERROR
-        msg = ('Changing directories for surface reflectance processing: {}'
-               .format(xmldir))
-        logger.info (msg)
-        os.chdir (xmldir)
+        logger.info ('Running surface reflectance processing in directory: %s',
+                     xmldir)
 
         # pull the date from the XML filename to determine which auxiliary
         # file should be used for input.
         # Example: S2A_MSI_L1C_T10TFR_20180816_20180903.xml uses the
         # L8ANC2018228.hdf_fused HDF file.
-        s2_prefixes_collection = ['S2A', 'S2B']
-        if base_xmlfile[0:3] in s2_prefixes_collection:
+        if base_xmlfile.startswith(S2_PREFIXES_COLLECTION):
             # Collection naming convention. Pull the year, month, day from the
             # XML filename. It should be the 4th group, separated by
             # underscores. Then convert month, day to DOY.
-            aux_date = base_xmlfile.split('_')[4]
-            aux_year = aux_date[0:4]
-            aux_month = aux_date[4:6]
-            aux_day = aux_date[6:8]
-            myday = datetime.date(int(aux_year), int(aux_month), int(aux_day))
-            aux_doy = myday.strftime("%j")
-            aux_file = 'L8ANC{}{}.hdf_fused'.format(aux_year, aux_doy)
+            try:
+                aux_date = base_xmlfile.split('_')[4]
+                myday = datetime.date(int(aux_date[0:4]), int(aux_date[4:6]),
+                                      int(aux_date[6:8]))
+            except (IndexError, ValueError):
+                logger.error ('Date could not be determined from the '
+                              'Sentinel-2 scene name: %s', base_xmlfile)
+                return ERROR
+            aux_doy = myday.timetuple().tm_yday
+            aux_file = 'L8ANC{}{:03d}.hdf_fused'.format(myday.year, aux_doy)
         else:
-            msg = ('Base XML filename is not recognized as a valid Sentinel-2 '
-                   'scene name'.format(base_xmlfile))
-            logger.error (msg)
-            os.chdir (mydir)
+            logger.error ('Base XML filename is not recognized as a valid '
+                          'Sentinel-2 scene name: %s', base_xmlfile)
             return ERROR
 
-        # run surface reflectance algorithm, checking the return status.  exit
-        # if any errors occur.
-        write_toa_opt_str = ''
-        use_orig_aero_alg_str = ''
-
+        # run surface reflectance algorithm from the XML directory, checking
+        # the return status.  exit if any errors occur.
+        cmd = ['lasrc', '--xml={}'.format(base_xmlfile),
+               '--aux={}'.format(aux_file)]
         if write_toa:
-            write_toa_opt_str = '--write_toa '
+            cmd.append('--write_toa')
         if use_orig_aero_alg:
-            use_orig_aero_alg_str = '--use_orig_aero_alg '
-        cmd = ['lasrc', f'--xml={xml_infile}', f'--aux={aux_file}',
-               f'{write_toa_opt_str}{use_orig_aero_alg_str}--verbose']
-        msg = 'Executing lasrc command: {}'.format(" ".join(cmd))
-        logger.debug(msg)
-        result = subprocess.run(cmd)
+            cmd.append('--use_orig_aero_alg')
+        cmd.append('--verbose')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Executing lasrc command: %s', ' '.join(cmd))
+        result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, text=True,
+                                cwd=xmldir, check=False)
         logger.info(result.stdout)
         if result.returncode != 0:
-            msg = 'Error running lasrc.  Processing will terminate.'
-            logger.error(msg)
-            os.chdir(mydir)
+            logger.error('Error running lasrc.  Processing will terminate.')
+            return ERROR
+        # successful completion
+        logger.info('Completion of surface reflectance.')
+        return SUCCESS
+
+
+    ########################################################################
+    # Description: runSrBatch runs the surface reflectance processing (see
+    # runSr) on each of the XML files listed in the specified file.  The XML
+    # files are independent of each other and are processed in parallel by a
+    # pool of worker processes, rather than starting this script once per
+    # XML file.
+    #
+    # Inputs:
+    #   xml_list - name of the file containing the list of input XML files,
+    #       one per line
+    #   write_toa - see runSr
+    #   use_orig_aero_alg - see runSr
+    #   workers - number of worker processes, each processing one directory
+    #       of XML files at a time.  Default is the number of CPUs.
+    #
+    # Returns:
+    #     ERROR - error running the surface reflectance application on one
+    #         or more of the XML files
+    #     SUCCESS - successful processing of all the XML files
+    #
+    # Notes:
+    #   1. Processing continues with the remaining XML files if one of them
+    #      fails, including if its processing raises an exception.
+    #   2. lasrc writes intermediate files with fixed names, such as
+    #      ipflag.img and aerosols.img, to its working directory, which is
+    #      the directory of the XML file.  Thus the XML files in the same
+    #      directory are processed one at a time, and only the XML files in
+    #      different directories are processed in parallel.
+    #######################################################################
+    def runSrBatch (
+        self,
+        xml_list,
+        write_toa=False,
+        use_orig_aero_alg=False,
+        workers=None
+    ):
+        # read the list of XML files, skipping blank lines
+        try:
+            with open(xml_list) as fh:
+                xml_files = [line.strip() for line in fh if line.strip()]
+        except IOError as e:
+            logger.error ('XML list file could not be read: %s: %s',
+                          xml_list, e.strerror)
             return ERROR
-        # successful completion.  return to the original directory.
-        os.chdir(mydir)
-        msg = 'Completion of surface reflectance.'
-        logger.info(msg)
+
+        # group the XML files by directory, so the lasrc runs sharing a
+        # working directory don't overwrite each other's intermediate files
+        groups = {}
+        for xml_infile in xml_files:
+            xmldir = os.path.dirname(os.path.abspath(xml_infile))
+            groups.setdefault(xmldir, []).append(xml_infile)
+
+        # process the directories in parallel.  only the XML filenames and
+        # options are passed to the workers.
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(group, executor.submit(_runSrGroupWorker, group,
+                                               write_toa, use_orig_aero_alg))
+                       for group in groups.values()]
+
+        # collect the status of each XML file.  a worker which didn't return
+        # the statuses, such as one which was killed, fails its XML files.
+        failed = []
+        for (group, future) in futures:
+            try:
+                statuses = future.result()
+            except Exception as e:
+                logger.error ('Surface reflectance of %s failed: %s',
+                              ', '.join(group), e)
+                statuses = [ERROR] * len(group)
+            failed.extend(xml_infile for (xml_infile, status)
+                          in zip(group, statuses) if status != SUCCESS)
+
+        if failed:
+            logger.error ('Surface reflectance failed for %d of %d XML '
+                          'files: %s', len(failed), len(xml_files),
+                          ', '.join(failed))
+            return ERROR
+
+        logger.info ('Completion of surface reflectance for %d XML files.',
+                     len(xml_files))
         return SUCCESS
 
 ######end of SurfaceReflectance class######
 
+
+#############################################################################
+# Description: _runSrWorker runs the surface reflectance processing on a
+# single XML file within a runSrBatch worker process.  Any exception is
+# logged and reported as an error, so it doesn't affect the other XML files.
+############################################################################
+def _runSrWorker(xml_infile, write_toa, use_orig_aero_alg):
+    try:
+        return SurfaceReflectance().runSr(xml_infile, write_toa,
+                                          use_orig_aero_alg)
+    except Exception:
+        logger.exception('Surface reflectance of %s failed', xml_infile)
+        return ERROR
+
+
+#############################################################################
+# Description: _runSrGroupWorker runs the surface reflectance processing on
+# each of the XML files in a single directory, one at a time, within a
+# runSrBatch worker process.  The status of each XML file is returned.
+############################################################################
+def _runSrGroupWorker(xml_files, write_toa, use_orig_aero_alg):
+    return [_runSrWorker(xml_infile, write_toa, use_orig_aero_alg)
+            for xml_infile in xml_files]
+
+
+#############################################################################
+# Description: main parses the command-line arguments and runs the surface
+# reflectance processing on the specified XML file, or on each of the XML
+# files in the specified list.
+#
+# Returns:
+#     ERROR - error running the surface reflectance application
+#     SUCCESS - successful processing
+############################################################################
+def main():
+    # get the command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument ("--version", dest="version", default=False,
+        action="store_true",
+        help="show the lasrc version number and exit")
+    xml_group = parser.add_mutually_exclusive_group()
+    xml_group.add_argument ("-i", "--xml", dest="xml",
+        help="name of XML file", metavar="FILE")
+    xml_group.add_argument ("--xml_list", dest="xml_list",
+        help="name of a file listing the XML files to process, "
+             "one per line", metavar="FILE")
+    parser.add_argument ("--write_toa", dest="write_toa", default=False,
+        action="store_true",
+        help="write the intermediate TOA reflectance products")
+    parser.add_argument ("--use_orig_aero_alg", dest="use_orig_aero_alg",
+        default=False, action="store_true",
+        help="use historical aerosol retrieval")
+    parser.add_argument ("--workers", type=int, dest="workers",
+        default=os.cpu_count() or 1,
+        help="number of directories of XML files from --xml_list to "
+             "process in parallel; the XML files within a directory are "
+             "processed one at a time (default is the number of CPUs)")
+    args = parser.parse_args()
+
+    # the version is only looked up from lasrc when it's requested
+    if args.version:
+        print (_lasrc_version())
+        return SUCCESS
+
+    # process the list of XML files, if specified
+    if args.workers < 1:
+        logger.error ('--workers must be at least 1')
+        return ERROR
+    if args.xml_list != None:
+        return SurfaceReflectance().runSrBatch (args.xml_list,
+            args.write_toa, args.use_orig_aero_alg, args.workers)
+
+    # XML input file
+    if args.xml == None:
+        parser.error ('missing input XML file command-line argument')
+
+    return SurfaceReflectance().runSr (args.xml, args.write_toa,
+                                       args.use_orig_aero_alg)
+
+
 if __name__ == "__main__":
     # setup the default logger format and level. log to STDOUT.
     logging.basicConfig(format=('%(asctime)s.%(msecs)03d %(process)d'
@@ -181,4 +325,4 @@ if __name__ == "__main__":
                                 '%(funcName)s -- %(message)s'),
                         datefmt='%Y-%m-%d %H:%M:%S',
                         level=logging.INFO)
-    sys.exit (SurfaceReflectance().runSr())
+    sys.exit (main())
@@ -0,0 +1,124 @@
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import do_lasrc_sentinel
+from unittest.mock import patch
+
+XML_FILE = "S2A_MSI_L1C_T10TFR_20180816_20180903.xml"
+
+
+def lasrc_run(failures=()):
+    # Stand-in for subprocess.run which succeeds, unless lasrc is run on one
+    # of the failing XML files, in which case it can't be started.
+    def run(cmd, **kwargs):
+        if cmd[1][len("--xml="):] in failures:
+            raise FileNotFoundError(2, "No such file or directory", "lasrc")
+        return subprocess.CompletedProcess(args=cmd, returncode=0, stdout="")
+    return run
+
+
+@patch("subprocess.run")
+def test_runSr(run, tmp_path):
+    run.side_effect = lasrc_run()
+    (tmp_path / XML_FILE).touch()
+    (tmp_path / "S2A_bad.xml").touch()
+    sr = do_lasrc_sentinel.SurfaceReflectance()
+
+    # lasrc is run on the base XML filename from the XML directory, with the
+    # auxiliary file for the date of the scene.
+    assert sr.runSr(str(tmp_path / XML_FILE), write_toa=True) == \
+        do_lasrc_sentinel.SUCCESS
+    assert run.call_args.args[0] == [
+        "lasrc", "--xml=" + XML_FILE, "--aux=L8ANC2018228.hdf_fused",
+        "--write_toa", "--verbose"]
+    assert run.call_args.kwargs["cwd"] == str(tmp_path)
+    run.reset_mock()
+
+    # A scene name without a date is an error rather than an exception.
+    assert sr.runSr(str(tmp_path / "S2A_bad.xml")) == do_lasrc_sentinel.ERROR
+    assert sr.runSr(str(tmp_path / "missing.xml")) == do_lasrc_sentinel.ERROR
+    assert run.call_count == 0
+
+
+@patch("subprocess.run")
+@patch.object(do_lasrc_sentinel, "ProcessPoolExecutor", ThreadPoolExecutor)
+def test_runSrBatch(run, tmp_path):
+    # The other scenes are still processed if one of them fails, or raises
+    # an exception.
+    failing = "S2B_MSI_L1C_T10TFR_20180817_20180903.xml"
+    run.side_effect = lasrc_run(failures=(failing,))
+    xml_files = [XML_FILE, "S2A_bad.xml", failing]
+    for name in xml_files:
+        (tmp_path / name).touch()
+    xml_list = tmp_path / "list.txt"
+    xml_list.write_text("\n".join(str(tmp_path / name) for name in xml_files)
+                        + "\n\n")
+
+    sr = do_lasrc_sentinel.SurfaceReflectance()
+    assert sr.runSrBatch(str(xml_list), workers=2) == do_lasrc_sentinel.ERROR
+    processed = sorted(c.args[0][1] for c in run.call_args_list)
+    assert processed == ["--xml=" + XML_FILE, "--xml=" + failing]
+
+    # All of the scenes succeeding is a success.
+    xml_list.write_text(str(tmp_path / XML_FILE) + "\n")
+    assert sr.runSrBatch(str(xml_list), workers=2) == do_lasrc_sentinel.SUCCESS
+
+
+@patch("subprocess.run")
+@patch.object(do_lasrc_sentinel, "ProcessPoolExecutor", ThreadPoolExecutor)
+def test_runSrBatch_directories(run, tmp_path):
+    # lasrc is never run on two scenes in the same directory at once, since
+    # its intermediate files would overwrite each other, but the directories
+    # are processed in parallel.
+    scenes = [XML_FILE, "S2B_MSI_L1C_T10TFR_20180817_20180903.xml"]
+    xml_files = []
+    for dirname in ("a", "b"):
+        (tmp_path / dirname).mkdir()
+        for name in scenes:
+            (tmp_path / dirname / name).touch()
+            xml_files.append(str(tmp_path / dirname / name))
+    xml_list = tmp_path / "list.txt"
+    xml_list.write_text("\n".join(xml_files) + "\n")
+
+    lock = threading.Lock()
+    running = []
+    same_dir = []
+    other_dir = []
+    def lasrc(cmd, cwd, **kwargs):
+        with lock:
+            same_dir.append(cwd in running)
+            running.append(cwd)
+        time.sleep(0.05)
+        with lock:
+            running.remove(cwd)
+            other_dir.append(len(running) > 0)
+        return subprocess.CompletedProcess(args=cmd, returncode=0, stdout="")
+    run.side_effect = lasrc
+
+    sr = do_lasrc_sentinel.SurfaceReflectance()
+    assert sr.runSrBatch(str(xml_list), workers=4) == do_lasrc_sentinel.SUCCESS
+    assert run.call_count == 4
+    assert not any(same_dir)
+    assert any(other_dir)
+
+
+@patch.object(do_lasrc_sentinel.SurfaceReflectance, "runSrBatch")
+def test_main(runSrBatch):
+    # At least one worker is needed to process a list of XML files.
+    argv = ["do_lasrc_sentinel.py", "--xml_list", "list.txt", "--workers"]
+    with patch("sys.argv", argv + ["0"]):
+        assert do_lasrc_sentinel.main() == do_lasrc_sentinel.ERROR
+    assert runSrBatch.call_count == 0
+
+    # The options are passed through to the batch processing.
+    runSrBatch.return_value = do_lasrc_sentinel.SUCCESS
+    with patch("sys.argv", argv + ["3", "--use_orig_aero_alg"]):
+        assert do_lasrc_sentinel.main() == do_lasrc_sentinel.SUCCESS
+    runSrBatch.assert_called_once_with("list.txt", False, True, 3)
+    runSrBatch.reset_mock()
+
+    # One worker is used if the number of CPUs can't be determined.
+    with patch("sys.argv", argv[:-1]), patch("os.cpu_count", return_value=None):
+        assert do_lasrc_sentinel.main() == do_lasrc_sentinel.SUCCESS
+    runSrBatch.assert_called_once_with("list.txt", False, False, 1)
@@ -1,59 +1,352 @@
 import pytest
 import subprocess
 import io
-from freezegun import freeze_time
+import json
+import os
+import requests
 from . import updatelads
-from unittest.mock import patch
-from urllib.request import HTTPError
+from unittest.mock import patch, MagicMock
 
 
-def fnmatch_side_effect(filename, pattern):
-    print(pattern)
-    if pattern == "L8ANC2021169.hdf_fused":
-        return False
-    elif pattern == "L8ANC2021168.hdf_fused":
-        return False
-    else:
-        return True
+def fake_downloads(statuses):
+    # Stand-in for downloadLads which creates the daily LAADS files in the
+    # destination and returns the next of the given statuses, along with the
+    # validators of the files.
+    statuses = iter(statuses)
 
+    def downloadLads(year, doy, destination, token=None, cache=None):
+        os.makedirs(destination, exist_ok=True)
+        validators = {}
+        for product in ("MOD09CMA", "MOD09CMG", "MYD09CMA", "MYD09CMG"):
+            name = "{}.A{}{:03d}.061.2021171000000.hdf".format(product, year,
+                                                             doy)
+            open(os.path.join(destination, name), "w").close()
+            validators[name] = {"etag": '"{}"'.format(doy),
+                                "last_modified": None}
+        return (next(statuses), validators)
+    return downloadLads
 
-@freeze_time("2021-6-20")
-@patch("subprocess.run")
-@patch("fnmatch.fnmatch")
+
+@patch("subprocess.Popen")
 @patch.object(updatelads, "downloadLads")
-@patch("os.listdir")
-@patch("os.path.exists")
-@patch("os.makedirs")
-def test_getLadsData(makedirs, exists, listdir, downloadLads, fnmatch, run):
+def test_getLadsData(downloadLads, popen, tmp_path):
+    # Only DOYs 169 and 168 are missing from the output directory, as of
+    # 2021-06-20.
+    ctx = updatelads.RunCtx(token="", current_year=2021, today_doy=171,
+                            today=True)
+    outputDir = tmp_path / "LADS" / "2021"
+    outputDir.mkdir(parents=True)
+    for doy in range(1, 168):
+        (outputDir / "L8ANC2021{:03d}.hdf_fused".format(doy)).touch()
+
     # Previous days are processed after combine_l8_aux_data fails for a day.
-    exists.side_effect = [True, False, True]
-    listdir.return_value = ['afile']
-    downloadLads.side_effect = [0, 0]
-    fnmatch.side_effect = fnmatch_side_effect
-    run.side_effect = subprocess.CalledProcessError(returncode=1, cmd=["none"])
-    updatelads.getLadsData("", 2021, True, "")
-    assert run.call_count == 2
-    run.reset_mock()
+    downloadLads.side_effect = fake_downloads([0, 0])
+    proc = popen.return_value.__enter__.return_value
+    proc.stdout = ["failed\n"]
+    proc.wait.return_value = 1
+    updatelads.getLadsData(str(tmp_path), 2021, ctx)
+    assert popen.call_count == 2
+    cmd = popen.call_args.args[0]
+    assert cmd[0] == "combine_l8_aux_data"
+    assert cmd[1:9:2] == ["--terra_cmg", "--terra_cma", "--aqua_cmg",
+                          "--aqua_cma"]
+    assert cmd[-3:] == ["--output_dir", str(outputDir), "--verbose"]
+    assert "shell" not in popen.call_args.kwargs
+    assert popen.call_args.kwargs["stdout"] == subprocess.PIPE
+    popen.reset_mock()
 
     # Previous days are processed if downloadLads fails for a day.
     # Side effect iterator needs to be reset through new assignment
-    exists.side_effect = [True, False, True]
-    downloadLads.side_effect = [0, 1]
-    fnmatch.side_effect = fnmatch_side_effect
-    run.return_value = subprocess.CompletedProcess(args=["none"], returncode=0)
-    updatelads.getLadsData("", 2021, True, "")
-    assert run.call_count == 1
-    run.reset_mock()
-
-
-@patch.object(updatelads, "urlopen")
-@patch.object(updatelads, "Request")
-def test_geturls(request, urlopen):
+    downloadLads.side_effect = fake_downloads([0, 1])
+    proc.wait.return_value = 0
+    updatelads.getLadsData(str(tmp_path), 2021, ctx)
+    assert popen.call_count == 1
+    popen.reset_mock()
+
+    # Previous days are processed if combine_l8_aux_data can't be run.
+    downloadLads.side_effect = fake_downloads([0, 0])
+    popen.side_effect = FileNotFoundError(2, "No such file or directory")
+    assert updatelads.getLadsData(str(tmp_path), 2021, ctx) == \
+        updatelads.SUCCESS
+    assert popen.call_count == 2
+    assert not (tmp_path / "LADS" / ".staging" / "2021").exists()
+    popen.side_effect = None
+    popen.reset_mock()
+
+    # --today stops at the most recent DOY which was already processed.
+    (outputDir / "L8ANC2021100.hdf_fused").unlink()
+    downloadLads.reset_mock()
+    downloadLads.side_effect = fake_downloads([0, 0])
+    updatelads.getLadsData(str(tmp_path), 2021, ctx)
+    doys = sorted(c.args[1] for c in downloadLads.call_args_list)
+    assert doys == [168, 169]
+
+
+@patch("subprocess.Popen")
+@patch.object(updatelads, "downloadLads")
+def test_getLadsData_etag_cache(downloadLads, popen, tmp_path):
+    # DOYs 167 through 169 are missing from the output directory.
+    ctx = updatelads.RunCtx(token="", current_year=2021, today_doy=171,
+                            today=True)
+    outputDir = tmp_path / "LADS" / "2021"
+    outputDir.mkdir(parents=True)
+    for doy in range(1, 167):
+        (outputDir / "L8ANC2021{:03d}.hdf_fused".format(doy)).touch()
+
+    # DOY 169 is downloaded and combined, combining DOY 168 fails and DOY
+    # 167 fails to download after some of its files changed.
+    statuses = {169: updatelads.SUCCESS, 168: updatelads.SUCCESS,
+                167: updatelads.ERROR}
+    downloadLads.side_effect = \
+        lambda year, doy, destination, token, cache: fake_downloads(
+            [statuses[doy]])(year, doy, destination, token, cache)
+
+    def fake_popen(cmd, **kwargs):
+        proc = MagicMock(stdout=[])
+        proc.wait.return_value = int(any("A2021168" in arg for arg in cmd))
+        result = MagicMock()
+        result.__enter__.return_value = proc
+        return result
+    popen.side_effect = fake_popen
+
+    # The validators are only recorded for the combined DOY, and an older
+    # validator of a file for the DOY which failed to combine is dropped.
+    etagFile = tmp_path / "LADS" / ".etag_cache.json"
+    etagFile.write_text(json.dumps({
+        "MOD09CMG.A2021168.061.2021171000000.hdf": {"etag": '"old"'}}))
+    updatelads.getLadsData(str(tmp_path), 2021, ctx)
+    etags = json.loads(etagFile.read_text())
+    assert sorted(etags) == [
+        "{}.A2021169.061.2021171000000.hdf".format(product)
+        for product in ("MOD09CMA", "MOD09CMG", "MYD09CMA", "MYD09CMG")]
+    assert {v["etag"] for v in etags.values()} == {'"169"'}
+
+
+def http_error(code, reason):
+    response = MagicMock(status_code=code, reason=reason)
+    return requests.HTTPError(response=response)
+
+
+@patch("subprocess.Popen")
+@patch.object(updatelads, "downloadMany")
+def test_getLadsData_interrupted(downloadMany, popen, tmp_path):
+    # DOY 169 is downloaded, then a server error stops the downloads.
+    ctx = updatelads.RunCtx(token="", current_year=2021, today_doy=171,
+                            today=True)
+    (tmp_path / "LADS" / "2021").mkdir(parents=True)
+
+    def fake_downloadMany(date_doy_pairs, destination, *args):
+        daydir = updatelads.downloadDir(destination, 2021, 169)
+        yield (2021, 169) + fake_downloads([0])(2021, 169, daydir)
+        raise http_error(503, "Service Unavailable")
+    downloadMany.side_effect = fake_downloadMany
+    proc = popen.return_value.__enter__.return_value
+    proc.stdout = []
+    proc.wait.return_value = 0
+
+    # The validators of the DOY which was combined are still recorded, and
+    # the staging directory is cleaned up.
+    with pytest.raises(requests.HTTPError):
+        updatelads.getLadsData(str(tmp_path), 2021, ctx)
+    assert popen.call_count == 1
+    etags = json.loads((tmp_path / "LADS" / ".etag_cache.json").read_text())
+    assert {v["etag"] for v in etags.values()} == {'"169"'}
+    assert len(etags) == 4
+    assert not (tmp_path / "LADS" / ".staging" / "2021").exists()
+
+
+@patch.object(updatelads, "geturl")
+def test_getLadsData_year_listing(geturl, tmp_path):
+    # DOYs 168 and 169 are missing from the output directory, and listing
+    # the Aqua CMG year directory fails with a server error.
+    ctx = updatelads.RunCtx(token="token", current_year=2021, today_doy=171,
+                            today=True)
+    outputDir = tmp_path / "LADS" / "2021"
+    outputDir.mkdir(parents=True)
+    (outputDir / "L8ANC2021167.hdf_fused").touch()
+
+    def fake_geturl(url, token=None, out=None, headers=None):
+        if url.endswith("/2021.csv"):
+            if "/MYD09CMG/" in url:
+                raise http_error(503, "Service Unavailable")
+            return "name, size\n168, 0\n169, 0\n"
+        return "name, size\n"
+    geturl.side_effect = fake_geturl
+    updatelads.listLadsDir.cache_clear()
+
+    # Each year directory is listed once for all of the DOYs, and the DOY
+    # directories are listed instead if the year directory can't be.
+    assert updatelads.getLadsData(str(tmp_path), 2021, ctx) == \
+        updatelads.SUCCESS
+    listings = sorted(c.args[0] for c in geturl.call_args_list)
+    assert listings == sorted(
+        [url + "2021.csv" for url in updatelads.LADS_PRODUCT_URLS] +
+        [url + "2021/{}.csv".format(doy)
+         for url in updatelads.LADS_PRODUCT_URLS for doy in (168, 169)])
+
+
+@patch.object(updatelads, "SESSION")
+def test_geturls(session):
+    response = session.get.return_value.__enter__.return_value
+
     # Bubble exception for 500 errors if there is a system issue with the
     # LAADS server or our tokens.
-    urlopen.side_effect = HTTPError("", 500, "failure", {}, None)
-    with pytest.raises(HTTPError):
+    response.raise_for_status.side_effect = http_error(500, "failure")
+    with pytest.raises(requests.HTTPError):
         updatelads.geturl("test", token="wat", out="fh")
 
-    urlopen.side_effect = HTTPError("", 404, "Bad Request", {}, None)
+    response.raise_for_status.side_effect = http_error(404, "Bad Request")
     updatelads.geturl("test", token="wat", out="fh")
+
+
+@patch.object(updatelads, "downloadLads")
+def test_downloadMany(downloadLads):
+    # Each DOY is downloaded to its own directory and every status is
+    # reported back, in whichever order the downloads complete.
+    downloadLads.side_effect = \
+        lambda year, doy, destination, token, cache: (doy % 2, {})
+    results = updatelads.downloadMany([(2021, 1), (2021, 2), (2021, 3)],
+                                      "/tmp/lads", "token", max_workers=2)
+    assert sorted(results) == [(2021, 1, 1, {}), (2021, 2, 0, {}),
+                               (2021, 3, 1, {})]
+    destinations = sorted(c.args[2] for c in downloadLads.call_args_list)
+    assert destinations == ["/tmp/lads/2021/001", "/tmp/lads/2021/002",
+                            "/tmp/lads/2021/003"]
+
+    # Only max_workers downloads are queued ahead of the caller.
+    downloadLads.reset_mock()
+    results = updatelads.downloadMany([(2021, doy) for doy in range(1, 11)],
+                                      "/tmp/lads", "token", max_workers=2)
+    next(results)
+    assert downloadLads.call_count <= 3
+    results.close()
+
+
+@patch.object(updatelads, "geturl")
+def test_downloadLads(geturl, tmp_path):
+    # Only the first product has files listed for the DOY.
+    listing = ("name, last_modified, size\n"
+               "MOD09CMA.A2021169.061.1.hdf, 2021-06-20 00:00, 4\n"
+               "MOD09CMA.A2021169.061.2.hdf, 2021-06-20 00:00, 4\n")
+
+    def fake_geturl(url, token=None, out=None, headers=None):
+        if out is None:
+            if url.endswith("/2021.csv"):
+                # DOY 169 isn't available yet for Aqua CMG
+                if "/MYD09CMG/" in url:
+                    return "name, size\n168, 0\n"
+                return "name, size\n168, 0\n169, 0\n"
+            return listing if "/MOD09CMA/" in url else "name, size\n"
+        out.write(b"data")
+        return MagicMock(status_code=200, headers={})
+    geturl.side_effect = fake_geturl
+    updatelads.listLadsDir.cache_clear()
+
+    # A complete download is kept, a partial download is fetched again and
+    # an older file that is no longer listed is cleaned up.
+    (tmp_path / "MOD09CMA.A2021169.061.1.hdf").write_bytes(b"data")
+    (tmp_path / "MOD09CMA.A2021169.061.2.hdf").write_bytes(b"da")
+    (tmp_path / "MOD09CMA.A2021169.061.0.hdf").write_bytes(b"data")
+    assert updatelads.downloadLads(2021, 169, str(tmp_path), "token")[0] == \
+        updatelads.SUCCESS
+    downloaded = [c.args[0] for c in geturl.call_args_list
+                  if c.args[0].endswith(".hdf")]
+    assert downloaded == [updatelads.TERRA_CMA_URL +
+                          "2021/169/MOD09CMA.A2021169.061.2.hdf"]
+    listings = [c.args[0] for c in geturl.call_args_list
+                if c.args[0].endswith("/169.csv")]
+    assert updatelads.AQUA_CMG_URL + "2021/169.csv" not in listings
+    assert len(listings) == 3
+    assert sorted(os.listdir(tmp_path)) == ["MOD09CMA.A2021169.061.1.hdf",
+                                            "MOD09CMA.A2021169.061.2.hdf"]
+    assert (tmp_path / "MOD09CMA.A2021169.061.2.hdf").read_bytes() == b"data"
+
+
+@patch.object(updatelads, "SESSION")
+def test_downloadLads_interrupted(session, tmp_path):
+    # The connection drops after the first half of the file was received.
+    def iter_content(chunk_size):
+        yield b"data"
+        raise requests.ConnectionError("Connection reset by peer")
+
+    def fake_get(url, **kwargs):
+        r = MagicMock(ok=True, status_code=200, headers={})
+        if url.endswith("/2021.csv"):
+            r.text = "name, size\n169, 0\n"
+        elif url.endswith(".csv"):
+            r.text = "name, size\n"
+            if "/MOD09CMA/" in url:
+                r.text += "MOD09CMA.A2021169.061.1.hdf, 8\n"
+        else:
+            r.iter_content.side_effect = iter_content
+        response = MagicMock()
+        response.__enter__.return_value = r
+        return response
+    session.get.side_effect = fake_get
+    updatelads.listLadsDir.cache_clear()
+
+    # The partial file isn't kept and the DOY fails rather than being
+    # combined from a truncated file.
+    assert updatelads.downloadLads(2021, 169, str(tmp_path), "token")[0] == \
+        updatelads.ERROR
+    assert os.listdir(tmp_path) == []
+
+    # Neither is the empty file of a download which failed with a server
+    # error.
+    def fail_get(url, **kwargs):
+        response = fake_get(url, **kwargs)
+        if url.endswith(".hdf"):
+            r = response.__enter__.return_value
+            r.ok = False
+            r.raise_for_status.side_effect = http_error(503, "Unavailable")
+        return response
+    session.get.side_effect = fail_get
+    assert updatelads.downloadLads(2021, 169, str(tmp_path), "token")[0] == \
+        updatelads.ERROR
+    assert os.listdir(tmp_path) == []
+
+
+@patch.object(updatelads, "geturl")
+def test_downloadLads_not_modified(geturl, tmp_path):
+    listing = ("name, last_modified, size\n"
+               "MOD09CMA.A2021169.061.1.hdf, 2021-06-20 00:00, 4\n")
+    modified = {"MOD09CMA.A2021169.061.1.hdf": False,
+                "MYD09CMA.A2021169.061.1.hdf": False}
+
+    def fake_geturl(url, token=None, out=None, headers=None):
+        if out is None:
+            if url.endswith("/2021.csv"):
+                return "name, size\n169, 0\n"
+            if "/MOD09CMA/" in url or "/MYD09CMA/" in url:
+                return listing.replace("MOD09CMA", url.split("/")[-3])
+            return "name, size\n"
+        name = url.rsplit("/", 1)[-1]
+        if headers and not modified.get(name, True):
+            return MagicMock(status_code=304)
+        out.write(b"data")
+        return MagicMock(status_code=200, headers={"ETag": '"' + name + '"'})
+    geturl.side_effect = fake_geturl
+    updatelads.listLadsDir.cache_clear()
+
+    # Nothing is downloaded when none of the cached files have changed.
+    cache = {"MOD09CMA.A2021169.061.1.hdf": {"etag": '"1"'},
+             "MYD09CMA.A2021169.061.1.hdf": {"etag": '"2"'}}
+    dest = tmp_path / "169"
+    (status, validators) = updatelads.downloadLads(2021, 169, str(dest),
+                                                   "token", cache)
+    assert status == updatelads.NOT_MODIFIED
+    assert validators == {}
+    assert os.listdir(dest) == []
+
+    # The unchanged files are downloaded too once any of the files changed,
+    # and the validators of the downloaded files are returned rather than
+    # being added to the cache.
+    modified["MYD09CMA.A2021169.061.1.hdf"] = True
+    (status, validators) = updatelads.downloadLads(2021, 169, str(dest),
+                                                   "token", cache)
+    assert status == updatelads.SUCCESS
+    assert sorted(os.listdir(dest)) == ["MOD09CMA.A2021169.061.1.hdf",
+                                        "MYD09CMA.A2021169.061.1.hdf"]
+    assert validators["MYD09CMA.A2021169.061.1.hdf"] == {
+        "etag": '"MYD09CMA.A2021169.061.1.hdf"', "last_modified": None}
+    assert cache["MYD09CMA.A2021169.061.1.hdf"] == {"etag": '"2"'}
@@ -5,20 +5,31 @@ from __future__ import (
 )
 import sys
 import os
-import fnmatch
+import re
+import calendar
 import datetime
+import functools
+import csv
+import json
 import subprocess
-import ssl
-from urllib.request import urlopen, Request, URLError, HTTPError
-from shutil import copyfileobj
+import shutil
+from dataclasses import dataclass
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from optparse import OptionParser
 import logging
 from io import StringIO
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
+logger = logging.getLogger(__name__)  # Get logger for the module.
+
 # Global static variables
 ERROR = 1
 SUCCESS = 0
+NOT_MODIFIED = 2    # none of the LAADS files changed since the last download
 START_YEAR = 2013
 # quarterly processing will reprocess back to the
 # start year to make sure all data is up to date
@@ -40,6 +51,115 @@ TERRA_CMA = '/archive/allData/6/MOD09CMA/'
 TERRA_CMG = '/archive/allData/6/MOD09CMG/'
 AQUA_CMA = '/archive/allData/6/MYD09CMA/'
 AQUA_CMG = '/archive/allData/6/MYD09CMG/'
+TERRA_CMA_URL = SERVER_URL + TERRA_CMA
+TERRA_CMG_URL = SERVER_URL + TERRA_CMG
+AQUA_CMA_URL = SERVER_URL + AQUA_CMA
+AQUA_CMG_URL = SERVER_URL + AQUA_CMG
+LADS_PRODUCT_URLS = (
+    TERRA_CMA_URL,      # TERRA CMA data (MOD09CMA)
+    TERRA_CMG_URL,      # TERRA CMG data (MOD09CMG)
+    AQUA_CMA_URL,       # AQUA CMA data (MYD09CMA)
+    AQUA_CMG_URL,       # AQUA CMG data (MYD09CMG)
+)
+
+# Pattern for the downloaded LAADS files, pulling out the product and the
+# year + DOY string.  Example: MOD09CMA.A2021169.061.2021171024353.hdf
+LADS_FILE_RE = re.compile(
+    r'(MOD09CMA|MOD09CMG|MYD09CMA|MYD09CMG)\.A(\d{7})\..*\.hdf$')
+
+# combine_l8_aux_data command-line option for each of the LAADS products
+COMBINE_OPTIONS = {
+    'MOD09CMG': '--terra_cmg',
+    'MOD09CMA': '--terra_cma',
+    'MYD09CMG': '--aqua_cmg',
+    'MYD09CMA': '--aqua_cma',
+}
+
+# Pattern for the combined daily auxiliary files, pulling out the year and
+# DOY.  Example: L8ANC2021169.hdf_fused
+L8ANC_FILE_RE = re.compile(r'L8ANC(\d{4})(\d{3})\.hdf_fused$')
+
+# Sidecar file, in the LADS directory, recording the ETag / Last-Modified
+# validators of the LAADS files which have been downloaded and combined
+ETAG_CACHE = '.etag_cache.json'
+
+# Default number of DOYs downloaded concurrently from LAADS
+DOWNLOAD_WORKERS = 16
+
+# Number of combine_l8_aux_data runs allowed alongside the downloads.  Each
+# run is CPU bound, so leave half of the cores for the downloads.
+COMBINE_WORKERS = max(2, (os.cpu_count() or 1) // 2)
+
+# Maximum number of downloaded DOYs waiting to be combined.  The downloads
+# pause once this many are queued up, which bounds the disk space used for
+# staging the downloads when combining is the slower of the two.
+COMBINE_BACKLOG = 8
+
+# Transient server errors (and throttling, honoring any Retry-After) are
+# retried with an exponential backoff, while client errors such as 401/404
+# fail immediately.  The backoff starts at a fraction of a second, since most
+# hiccups clear up that quickly, and only the idempotent GET/HEAD requests
+# are retried.  raise_on_status is off so the final error response is still
+# handled by geturl.
+RETRY = Retry(total=5, backoff_factor=0.5,
+              status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods=('GET', 'HEAD'),
+              respect_retry_after_header=True,
+              raise_on_status=False)
+
+
+def mountLadsAdapter(session, workers):
+    """
+    Mounts the HTTPS adapter for the LAADS requests on the session, keeping
+    one pooled connection for each of the download workers.  The pool blocks
+    once all of its connections are in use, so it also bounds the number of
+    concurrent requests to LAADS.
+
+    Args:
+      session: requests session to mount the adapter on
+      workers: number of concurrent download workers
+    """
+    session.mount('https://', HTTPAdapter(pool_connections=4,
+                                          pool_maxsize=workers,
+                                          pool_block=True,
+                                          max_retries=RETRY))
+
+
+# Persistent HTTPS session shared by all LAADS requests so the TCP/TLS
+# connections are reused across listings and downloads.  The (connect, read)
+# timeout makes a stalled connection fail, and therefore be retried, instead
+# of hanging.
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': USERAGENT})
+mountLadsAdapter(SESSION, DOWNLOAD_WORKERS)
+TIMEOUT = (10, 300)
+
+# Chunk size used when streaming downloads to disk.  The LAADS HDF files are
+# several MB, so large chunks keep the number of read/write calls down.  Each
+# chunk is larger than the file's own buffer, so it is written straight
+# through to the file.
+COPY_BUFSIZE = 1 << 20
+
+
+@dataclass
+class RunCtx:
+    """
+    Settings for a run which are shared by the processing of each year.  They
+    are determined once, in main, rather than for every year.
+
+    Attributes:
+      token: application token for the desired website
+      current_year: year of the date the run started (integer)
+      today_doy: day of year of the date the run started (integer)
+      today: specifies if we are just bringing the LAADS data up to date vs.
+             reprocessing the data
+      workers: number of DOYs to download concurrently
+    """
+    token: str
+    current_year: int
+    today_doy: int
+    today: bool = False
+    workers: int = DOWNLOAD_WORKERS
 
 
 def isLeapYear(year):
@@ -53,44 +173,138 @@ def isLeapYear(year):
       True: yes, this is a leap year
       False: no, this is not a leap year
     """
-    if (year % 4) == 0:
-        if (year % 100) == 0:
-            if (year % 400) == 0:
-                return True
-            else:
-                return False
-        else:
-            return True
-    else:
-        return False
+    return calendar.isleap(year)
 
 
-def geturl(url, token=None, out=None):
-    logger = logging.getLogger(__name__)
-    headers = {'user-agent': USERAGENT}
+def geturl(url, token=None, out=None, headers=None):
+    """
+    Retrieves the specified URL from LAADS.  Listings are returned as text,
+    while downloads are streamed to the output file.
+
+    Args:
+      url: URL to retrieve
+      token: application token for the desired website
+      out: open binary file to write the download to, or None for a listing
+      headers: additional request headers, such as conditional headers
+
+    Returns:
+      None: error occurred while retrieving the URL
+      text: text of the listing, if out is None
+      response: response of the download (304 if not modified), otherwise
+    """
     if token:
-        headers['Authorization'] = 'Bearer ' + token
-        CTX = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        headers = dict(headers or {}, Authorization='Bearer ' + token)
         try:
-            fh = urlopen(Request(url, headers=headers), context=CTX)
-            if out is None:
-                return fh.read().decode('utf-8')
-            else:
-                copyfileobj(fh, out)
-        except HTTPError as e:
-            msg = f'Downloading {url} failed with {e.code} due to {e.reason}'
-            logger.error(msg)
-            if e.code >= 500:
+            with SESSION.get(url, headers=headers, stream=True,
+                             timeout=TIMEOUT) as r:
+                if not r.ok:
+                    # read the (small) error body so the connection goes
+                    # back to the session pool instead of being closed
+                    r.content
+                r.raise_for_status()
+                if out is None:
+                    return r.text
+                else:
+                    for chunk in r.iter_content(COPY_BUFSIZE):
+                        out.write(chunk)
+                    return r
+        except requests.HTTPError as e:
+            code = e.response.status_code
+            logger.error('Downloading %s failed with %s due to %s', url, code,
+                         e.response.reason)
+            if code >= 500:
                 raise e
-        except URLError as e:
-            msg = f'Downloading {url} failed due to {e.reason}'
-            logger.error(msg)
+        except requests.RequestException as e:
+            logger.error('Downloading %s failed due to %s', url, e)
+
 
+def loadEtagCache(path):
+    """
+    Reads the ETag / Last-Modified validators of the previously downloaded
+    LAADS files.  A missing or unreadable cache is treated as empty, so the
+    files are simply downloaded again.
+
+    Args:
+      path: name of the JSON cache file
+
+    Returns:
+      cache: dict of {filename: {'etag': ..., 'last_modified': ...}}
+    """
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
 
+
+def saveEtagCache(path, cache):
+    """
+    Writes the ETag / Last-Modified validators of the downloaded LAADS files.
+    The cache is written to a temporary file and then renamed, so an
+    interrupted run never leaves a truncated cache behind.
+
+    Args:
+      path: name of the JSON cache file
+      cache: dict of {filename: {'etag': ..., 'last_modified': ...}}
+    """
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w') as fh:
+        json.dump(cache, fh, indent=1, sort_keys=True)
+    os.replace(tmpPath, path)
+
+
+def conditionalHeaders(validators):
+    """
+    Builds the conditional GET headers for a previously downloaded file, so
+    LAADS responds with 304 Not Modified rather than the file if it hasn't
+    changed.
+
+    Args:
+      validators: dict of the 'etag' and 'last_modified' of the file
+
+    Returns:
+      headers: dict of the If-None-Match / If-Modified-Since headers
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+@functools.lru_cache(maxsize=None)
+def listLadsDir(url, token=None):
+    """
+    Retrieves the names of the entries in the specified LAADS directory, such
+    as the DOY directories for a product and year.  The listing is cached so
+    each directory is only listed once per run.
+
+    Args:
+      url: URL of the LAADS directory, without a trailing '/'
+      token: application token for the desired website
+
+    Returns:
+      None: the listing could not be retrieved
+      names: frozenset of the entry names in the directory
+    """
+    try:
+        listing = geturl(url + '.csv', token)
+    except requests.HTTPError:
+        # a server error on the listing isn't fatal, as the DOY directories
+        # can still be listed individually
+        return None
+    if listing is None:
+        return None
+    return frozenset(f['name'] for f in csv.DictReader(StringIO(listing),
+                                                       skipinitialspace=True))
+
+
+@functools.lru_cache(maxsize=2048)
 def buildURLs(year, doy):
     """
     Builds the URLs for the Terra and Aqua CMG and CMA products for the
-    current year and DOY, and put that URL on the list.
+    current year and DOY.
 
     Args:
       year: year of desired LAADS data
@@ -99,37 +313,129 @@ def buildURLs(year, doy):
     Returns:
       None: error resolving the instrument and associated URL for the
             specified year and DOY
-      urlList: list of URLs to pull the LAADS data from for the specified
+      urlList: tuple of URLs to pull the LAADS data from for the specified
                year and DOY.
     """
-    urlList = []     # create empty URL list
+    suffix = '{}/{:03d}'.format(year, doy)
+    return tuple(url + suffix for url in LADS_PRODUCT_URLS)
 
-    # append TERRA CMA data (MOD09CMA)
-    url = ('{}{}{}/{:03d}'.format(SERVER_URL, TERRA_CMA, year, doy))
-    urlList.append(url)
 
-    # append TERRA CMG data (MOD09CMG)
-    url = ('{}{}{}/{:03d}'.format(SERVER_URL, TERRA_CMG, year, doy))
-    urlList.append(url)
-
-    # append AQUA CMA data (MYD09CMA)
-    url = ('{}{}{}/{:03d}'.format(SERVER_URL, AQUA_CMA, year, doy))
-    urlList.append(url)
-
-    # append AQUA CMG data (MYD09CMG)
-    url = ('{}{}{}/{:03d}'.format(SERVER_URL, AQUA_CMG, year, doy))
-    urlList.append(url)
-
-    return urlList
+def downloadProduct(url, destination, token=None, cache=None,
+                    conditional=True, validators=None):
+    """
+    Retrieves the HDF files for one of the Aqua/Terra CMG/CMA products for a
+    year and DOY from the LAADS https interface and downloads them to the
+    desired destination.  Files already in the download directory are kept,
+    and not downloaded again, if their size matches the LAADS listing.
 
+    Args:
+      url: URL of the product's DOY directory, without a trailing '/'
+      destination: name of the directory on the local system to download the
+          LAADS files
+      token: application token for the desired website
+      cache: dict of the ETag / Last-Modified validators of the previously
+          downloaded files
+      conditional: use conditional GETs for the files in the cache.  Files
+          which haven't changed are then not downloaded at all.
+      validators: dict which the ETag / Last-Modified validators of the
+          downloaded files are added to.  None to not track the validators.
 
-def downloadLads(year, doy, destination, token=None):
+    Returns:
+      None: error occurred while processing
+      listed: set of the names of the HDF files in the LAADS listing
+    """
+    listed = set()   # names of the files in the LAADS listing
+
+    # skip the DOY if the (cached) listing of the product's year shows it
+    # isn't available, rather than requesting its listing
+    (yearurl, doystr) = url.rsplit('/', 1)
+    available = listLadsDir(yearurl, token)
+    if available is not None and doystr not in available:
+        logger.warning('No files were found in %s. Continue processing.', url)
+        return listed
+
+    logger.info('Retrieving %s to %s', url, destination)
+
+    # get the CSV listing of files in this URL
+    listing = geturl(url + '.csv', token) or ''
+    files = list(csv.DictReader(StringIO(listing), skipinitialspace=True))
+
+    # log a warning if no files were found
+    if len(files) == 0:
+        logger.warning('No files were found in %s. Continue processing.', url)
+        return listed
+
+    # loop through the file listing and download the HDF files directly.
+    # skip any directories, which technically shouldn't even exist.
+    for f in files:
+        # currently we use filesize of 0 to indicate directory, and there
+        # should only be files in this path
+        filesize = int(f['size'])
+        if filesize == 0 or not f['name'].endswith('.hdf'):
+            continue
+        listed.add(f['name'])
+        path = os.path.join(destination, f['name'])
+        fileurl = url + '/' + f['name']
+        try:
+            # skip files which were already completely downloaded
+            if os.path.isfile(path) and os.path.getsize(path) == filesize:
+                logger.info('Skipping: %s', path)
+                continue
+
+            headers = None
+            if conditional and cache is not None and f['name'] in cache:
+                headers = conditionalHeaders(cache[f['name']])
+            logger.debug('downloading: %s', path)
+            with open(path, 'wb') as fh:
+                r = geturl(fileurl, token, fh, headers)
+
+            # a failed or interrupted download leaves a missing or partial
+            # file behind, which must not be combined
+            if r is None or (r.status_code != 304 and
+                             os.path.getsize(path) != filesize):
+                logger.error('Incomplete download of %s', fileurl)
+                os.remove(path)
+                return None
+            if r.status_code == 304:
+                # unchanged since it was last downloaded.  don't leave the
+                # empty file behind, as it isn't a download.
+                logger.info('Not modified: %s', fileurl)
+                os.remove(path)
+            elif validators is not None:
+                validators[f['name']] = {
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }
+
+        except requests.RequestException as e:
+            # a server error on the download is re-raised by geturl.  the
+            # requests exceptions are IOErrors too, but carry no filename.
+            logger.error('Download of %s failed with %s', fileurl,
+                         getattr(e.response, 'status_code', None))
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        except IOError as e:
+            logger.warning('Open %s: %s', e.filename, e.strerror)
+            return None
+
+    return listed
+
+
+def downloadLads(year, doy, destination, token=None, cache=None):
     """
     Retrieves the files for the specified year and DOY from the LAADS https
     interface and download to the desired destination.  If the destination
-    directory does not exist, then it is made before downloading.  Existing
-    files in the download directory are removed/cleaned.  This will download
-    the Aqua/Terra CMG and CMA files for the current year, DOY.
+    directory does not exist, then it is made before downloading.  Files
+    already in the download directory are kept, and not downloaded again, if
+    their size matches the LAADS listing.  Any other files in the download
+    directory are removed/cleaned.  This will download the Aqua/Terra CMG and
+    CMA files for the current year, DOY, with the products retrieved
+    concurrently.
+
+    Files with validators in the cache are requested with conditional GETs.
+    If none of the files changed nothing is downloaded, otherwise the
+    unchanged files are downloaded as well so the DOY can be combined.
 
     Args:
       year: year of data to download (integer)
@@ -137,91 +443,186 @@ def downloadLads(year, doy, destination, token=None):
       destination: name of the directory on the local system to download the
           LAADS files
       token: application token for the desired website
+      cache: dict of the ETag / Last-Modified validators of the previously
+          downloaded files
 
     Returns:
-      ERROR: error occurred while processing
-      SUCCESS: processing completed successfully
+      (status, validators) tuple, where status is one of
+        ERROR: error occurred while processing
+        SUCCESS: processing completed successfully
+        NOT_MODIFIED: none of the files changed since they were cached
+      and validators is a dict of the ETag / Last-Modified validators of the
+      files which were downloaded.  The caller only records these in the
+      cache once the files have been combined.
     """
-    # get the logger
-    logger = logging.getLogger(__name__)
-
-    # make sure the download directory exists (and is cleaned up) or create
-    # it recursively
+    # make sure the download directory exists or create it recursively
     if not os.path.exists(destination):
-        msg = '{} does not exist... creating'.format(destination)
-        logger.info(msg)
+        logger.info('%s does not exist... creating', destination)
         os.makedirs(destination, 0o777)
-    else:
-        # directory already exists and possibly has files in it.  any old
-        # files need to be cleaned up
-        msg = 'Cleaning download directory: {}'.format(destination)
-        logger.info(msg)
-        for myfile in os.listdir(destination):
-            name = os.path.join(destination, myfile)
-            if not os.path.isdir(name):
-                os.remove(name)
 
     # obtain the list of URL(s) for our particular date.  this includes the
     # locations for the Aqua and Terra CMG/CMA files.
     urlList = buildURLs(year, doy)
     if urlList is None:
-        msg = ('LAADS URLs could not be resolved for year {} and DOY {}'
-               .format(year, doy))
-        logger.error(msg)
-        return ERROR
+        logger.error('LAADS URLs could not be resolved for year %s and DOY %s',
+                     year, doy)
+        return (ERROR, {})
+
+    # download the data for the current year from the list of URLs.  the
+    # products are independent, so they are retrieved at the same time
+    # rather than waiting on each product's listing and download in turn.
+    # the session's connection pool bounds the overall number of requests.
+    logger.info('Downloading data for %s/%s to %s', year, doy, destination)
+    validators = {}
+    with ThreadPoolExecutor(max_workers=len(urlList)) as executor:
+        products = list(executor.map(
+            functools.partial(downloadProduct, destination=destination,
+                              token=token, cache=cache,
+                              validators=validators), urlList))
+        if None in products:
+            return (ERROR, validators)
+        listed = set().union(*products)   # names of the files in the listings
+
+        # the files which weren't modified are the only listed files not in
+        # the download directory.  if all of them are unchanged, then there
+        # is nothing to do for this DOY.  otherwise the unchanged files are
+        # needed too, along with the changed ones.
+        unchanged = [name for name in listed
+                     if not os.path.isfile(os.path.join(destination, name))]
+        if listed and len(unchanged) == len(listed):
+            return (NOT_MODIFIED, validators)
+        if unchanged:
+            products = list(executor.map(
+                functools.partial(downloadProduct, destination=destination,
+                                  token=token, cache=cache, conditional=False,
+                                  validators=validators), urlList))
+            if None in products:
+                return (ERROR, validators)
+
+    # any other files in the download directory, such as older versions of
+    # the products, need to be cleaned up
+    with os.scandir(destination) as entries:
+        for entry in entries:
+            if not entry.is_dir() and entry.name not in listed:
+                logger.info('Cleaning old download: %s', entry.path)
+                os.remove(entry.path)
+
+    return (SUCCESS, validators)
+
+
+def downloadDir(destination, year, doy):
+    """
+    Builds the name of the download directory for the specified year and DOY
+    under the base download directory.  Each DOY gets its own directory so
+    concurrent downloads don't clean up each other's files.
 
-    # download the data for the current year from the list of URLs.
-    msg = 'Downloading data for {}/{} to {}'.format(year, doy, destination)
-    logger.info(msg)
-    for url in urlList:
-        msg = 'Retrieving {} to {}'.format(url, destination)
-        logger.info(msg)
+    Args:
+      destination: name of the base download directory
+      year: year of data to download (integer)
+      doy: day of year of data to download (integer)
 
-        # get a listing of files in this URL
-        try:
-            import csv
-            files = [
-                f for f in csv.DictReader(
-                    StringIO(geturl('%s.csv' % url, token)),
-                    skipinitialspace=True
-                )
-            ]
-        except ImportError:
-            import json
-            files = json.loads(geturl(url + '.json', token))
-
-        # log a warning if no files were found
-        if len(files) == 0:
-            msg = 'No files were found in {}. Continue processing.'.format(url)
-            logger.warn(msg)
-            continue
+    Returns:
+      name of the download directory for the year and DOY
+    """
+    return '{}/{}/{:03d}'.format(destination, year, doy)
 
-        # loop through the file listing and download the files. skip any
-        # directories, which technically shouldn't even exist.
-        for f in files:
-            # currently we use filesize of 0 to indicate directory, and there
-            # should only be files in this path
-            filesize = int(f['size'])
-            path = os.path.join(destination, f['name'])
-            url = url + '/' + f['name']
-            if filesize != 0:
-                try:
-                    if not os.path.exists(path):
-                        logger.debug('downloading: {}'.format(path))
-                        with open(path, 'w+b') as fh:
-                            geturl(url, token, fh)
-                    else:
-                        logger.warn('Skipping: {}'.format(path))
-
-                except IOError as e:
-                    msg = 'Open {}: {}'.format(e.filename, e.strerror)
-                    logger.warn(msg)
-                    return ERROR
 
+def downloadMany(date_doy_pairs, destination, token=None,
+                 max_workers=DOWNLOAD_WORKERS, cache=None):
+    """
+    Retrieves the LAADS files for each of the specified year and DOY pairs
+    using a pool of worker threads, which share the persistent LAADS session.
+    The files for each pair are downloaded to their own directory under the
+    destination (see downloadDir).  Only max_workers downloads are queued at
+    a time, and the next one is queued as each download completes, so the
+    downloads don't get ahead of a caller which is slow to consume them.
+
+    Args:
+      date_doy_pairs: iterable of (year, doy) tuples of data to download
+      destination: name of the base directory on the local system to
+          download the LAADS files
+      token: application token for the desired website
+      max_workers: maximum number of concurrent downloads
+      cache: dict of the ETag / Last-Modified validators of the previously
+          downloaded files (see downloadLads)
+
+    Returns:
+      generator of (year, doy, status, validators) tuples in the order the
+      downloads complete, where status and validators are the return of
+      downloadLads
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pairs = iter(date_doy_pairs)
+    futures = {}
+
+    def submit(count):
+        for (year, doy) in itertools.islice(pairs, count):
+            future = executor.submit(downloadLads, year, doy,
+                                     downloadDir(destination, year, doy),
+                                     token, cache)
+            futures[future] = (year, doy)
+
+    try:
+        submit(max_workers)
+        while futures:
+            (completed, _) = wait(futures, return_when=FIRST_COMPLETED)
+            for future in completed:
+                # keep the worker busy with the next DOY while the caller
+                # handles this one
+                (year, doy) = futures.pop(future)
+                submit(1)
+                (status, validators) = future.result()
+                yield (year, doy, status, validators)
+    finally:
+        # don't start any queued downloads if the caller stopped early
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def combineLads(cmd, year, doy, daydir=None):
+    """
+    Runs combine_l8_aux_data to combine the downloaded CMG and CMA products
+    for the specified year and DOY.  Once they are combined, the downloaded
+    products are removed so the staged downloads don't build up over the
+    year.
+
+    Args:
+      cmd: combine_l8_aux_data command-line arguments and executable
+      year: year of the data being combined (integer)
+      doy: day of year of the data being combined (integer)
+      daydir: download directory of the products for the DOY
+
+    Returns:
+      ERROR: error occurred while processing
+      SUCCESS: processing completed successfully
+    """
+    logger.info('Executing %s', ' '.join(cmd))
+    # log the output as it is written, tagged with the date since the
+    # combines for several DOYs run at the same time
+    try:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, text=True,
+                              bufsize=1) as proc:
+            for line in proc.stdout:
+                logger.info('%s/%03d: %s', year, doy, line.rstrip())
+            returncode = proc.wait()
+    except OSError as e:
+        # such as combine_l8_aux_data not being found in the PATH
+        logger.error('Unable to run %s for year %s, DOY %s: %s', cmd[0], year,
+                     doy, e)
+        return ERROR
+    if returncode != 0:
+        logger.error('Error running combine_l8_aux_data for year %s, DOY %s',
+                     year, doy)
+        return ERROR
+
+    if daydir is not None:
+        shutil.rmtree(daydir, ignore_errors=True)
     return SUCCESS
 
 
-def getLadsData(auxdir, year, today, token):
+def getLadsData(auxdir, year, ctx):
     """
     Description: getLadsData downloads the daily MODIS Aqua/Terra CMG and CMA
     data files for the desired year, then combines those files into one daily
@@ -230,218 +631,190 @@ def getLadsData(auxdir, year, today, token):
       auxdir: name of the base L8_SR auxiliary directory which contains the
               LAADS directory
       year: year of LAADS data to be downloaded and processed (integer)
-      today: specifies if we are just bringing the LAADS data up to date vs.
-             reprocessing the data
-      token: application token for the desired website
+      ctx: RunCtx settings of the run, such as the token and today's date
 
     Returns:
         ERROR: error occurred while processing
         SUCCESS: processing completed successfully
     """
-    # get the logger
-    logger = logging.getLogger(__name__)
-
     # determine the directory for the output auxiliary data files to be
     # processed.  create the directory if it doesn't exist.
     outputDir = '{}/LADS/{}'.format(auxdir, year)
     if not os.path.exists(outputDir):
-        msg = '{} does not exist... creating'.format(outputDir)
-        logger.info(msg)
+        logger.info('%s does not exist... creating', outputDir)
         os.makedirs(outputDir, 0o777)
 
     # if the specified year is the current year, only process up through
     # today (actually 2 days earlier due to the LAADS data lag) otherwise
     # process through all the days in the year
-    now = datetime.datetime.now()
-    if year == now.year:
+    if year == ctx.current_year:
         # start processing LAADS data with a 2-day time lag. if the 2-day lag
         # puts us into last year, then we are done with the current year.
-        day_of_year = now.timetuple().tm_yday - 2
+        day_of_year = ctx.today_doy - 2
         if day_of_year <= 0:
             return SUCCESS
     else:
-        if isLeapYear(year) is True:
-            day_of_year = 366
-        else:
-            day_of_year = 365
-
-    # set the download directory in /tmp/lads
-    dloaddir = '/tmp/lads/{}'.format(year)
-
-    # loop through each day in the year and process the LAADS data.  process
-    # in the reverse order so that if we are handling data for "today", then
-    # we can stop as soon as we find the current DOY has been processed.
+        day_of_year = 366 if isLeapYear(year) else 365
+
+    # set the download directory to a staging area in the LADS directory,
+    # which keeps the downloads on the same filesystem as the combined
+    # output rather than filling up /tmp.  each DOY is downloaded to its own
+    # subdirectory.
+    dloadbase = '{}/LADS/.staging'.format(auxdir)
+    dloaddir = '{}/{}'.format(dloadbase, year)
+
+    # get the year + DOY strings of the dates which have already been
+    # processed, listing the output directory only once
+    done = set()
+    with os.scandir(outputDir) as entries:
+        for entry in entries:
+            match = L8ANC_FILE_RE.match(entry.name)
+            if match:
+                done.add(match.group(1) + match.group(2))
+
+    # only validate the cached LAADS files of the dates which have already
+    # been processed; the files for any other date need to be downloaded in
+    # order to be combined
+    etagFile = '{}/LADS/{}'.format(auxdir, ETAG_CACHE)
+    etags = loadEtagCache(etagFile)
+    cache = {}
+    for (name, validators) in etags.items():
+        match = LADS_FILE_RE.match(name)
+        if match and match.group(2) in done:
+            cache[name] = validators
+
+    # loop through each day in the year and determine which days need to be
+    # processed.  process in the reverse order so that if we are handling
+    # data for "today", then we can stop as soon as we find the current DOY
+    # has been processed.
+    date_doy_pairs = []
     for doy in range(day_of_year, 0, -1):
         # get the year + DOY string
         datestr = '{}{:03d}'.format(year, doy)
 
         # if the data for the current year and doy exists already, then we are
-        # going to skip that file if processing for the --today.  For
-        # --quarterly, we will completely reprocess.
-        skip_date = False
-        for myfile in os.listdir(outputDir):
-            if fnmatch.fnmatch(myfile, 'L8ANC' + datestr + '.hdf_fused') \
-                    and today:
-                msg = 'L8ANC{}.hdf_fused already exists. Skip.'.format(datestr)
-                logger.info(msg)
-                skip_date = True
-                break
-        if skip_date:
-            continue
-        # download the daily LAADS files for the specified year and DOY
-        found_mod09cma = True
-        found_mod09cmg = True
-        found_myd09cma = True
-        found_myd09cmg = True
-        status = downloadLads(year, doy, dloaddir, token)
-        if status == ERROR:
-            # If download fails continue processing previous days
-            continue
-
-        # get the Terra CMA file for the current DOY (should only be one)
-        fileList = []    # create empty list to store files matching date
-        for myfile in os.listdir(dloaddir):
-            if fnmatch.fnmatch(myfile, 'MOD09CMA.A' + datestr + '*.hdf'):
-                fileList.append(myfile)
-
-        # make sure files were found or print a warning
-        nfiles = len(fileList)
-        if nfiles == 0:
-            found_mod09cma = False
-        else:
-            # if only one file was found which matched our date, then that's
-            # the file we'll process.  if more than one was found, then we
-            # have a problem as only one file is expected.
-            if nfiles == 1:
-                terra_cma = dloaddir + '/' + fileList[0]
-            else:
-                msg = ('Multiple LAADS MOD09CMA files found for doy {} year {}'
-                       .format(doy, year))
-                logger.error(msg)
-                return ERROR
-
-        # get the Terra CMG file for the current DOY (should only be one)
-        fileList = []    # create empty list to store files matching date
-        for myfile in os.listdir(dloaddir):
-            if fnmatch.fnmatch(myfile, 'MOD09CMG.A' + datestr + '*.hdf'):
-                fileList.append(myfile)
-
-        # make sure files were found or print a warning
-        nfiles = len(fileList)
-        if nfiles == 0:
-            found_mod09cmg = False
-        else:
-            # if only one file was found which matched our date, then that's
-            # the file we'll process.  if more than one was found, then we
-            # have a problem as only one file is expected.
-            if nfiles == 1:
-                terra_cmg = dloaddir + '/' + fileList[0]
-            else:
-                msg = ('Multiple LAADS MOD09CMG files found for doy {} year {}'
-                       .format(doy, year))
-                logger.error(msg)
-                return ERROR
-
-        # get the Aqua CMA file for the current DOY (should only be one)
-        fileList = []    # create empty list to store files matching date
-        for myfile in os.listdir(dloaddir):
-            if fnmatch.fnmatch(myfile, 'MYD09CMA.A' + datestr + '*.hdf'):
-                fileList.append(myfile)
-
-        # make sure files were found or print a warning
-        nfiles = len(fileList)
-        if nfiles == 0:
-            found_myd09cma = False
-        else:
-            # if only one file was found which matched our date, then that's
-            # the file we'll process.  if more than one was found, then we
-            # have a problem as only one file is expected.
-            if nfiles == 1:
-                aqua_cma = dloaddir + '/' + fileList[0]
-            else:
-                msg = ('Multiple LAADS MOD09CMA files found for doy {} year {}'
-                       .format(doy, year))
-                logger.error(msg)
-                return ERROR
-
-        # get the Aqua CMG file for the current DOY (should only be one)
-        fileList = []    # create empty list to store files matching date
-        for myfile in os.listdir(dloaddir):
-            if fnmatch.fnmatch(myfile, 'MYD09CMG.A' + datestr + '*.hdf'):
-                fileList.append(myfile)
-
-        # make sure files were found or print a warning
-        nfiles = len(fileList)
-        if nfiles == 0:
-            found_myd09cmg = False
-        else:
-            # if only one file was found which matched our date, then that's
-            # the file we'll process.  if more than one was found, then we
-            # have a problem as only one file is expected.
-            if nfiles == 1:
-                aqua_cmg = dloaddir + '/' + fileList[0]
+        # done if processing for the --today, as the earlier DOYs have been
+        # brought up to date already.  For --quarterly, we will completely
+        # reprocess.
+        if ctx.today and datestr in done:
+            logger.info('L8ANC%s.hdf_fused already exists. Done with year %s.',
+                        datestr, year)
+            break
+        date_doy_pairs.append((year, doy))
+
+    # list the year directory of each product up front, so the download
+    # threads all find the listing in the cache rather than each listing it
+    if date_doy_pairs:
+        with ThreadPoolExecutor(max_workers=len(LADS_PRODUCT_URLS)) as pool:
+            list(pool.map(lambda url: listLadsDir(url + str(year), ctx.token),
+                          LADS_PRODUCT_URLS))
+
+    # download the daily LAADS files for the remaining DOYs in parallel and
+    # process each DOY as soon as its download completes, overlapping the
+    # combining of the completed DOYs with the downloads
+    combines = []
+    try:
+        with ThreadPoolExecutor(max_workers=COMBINE_WORKERS) as combinePool:
+            for (year, doy, status, validators) in downloadMany(
+                    date_doy_pairs, dloadbase, ctx.token, ctx.workers, cache):
+                if status == ERROR:
+                    # If download fails continue processing previous days
+                    continue
+                if status == NOT_MODIFIED:
+                    logger.info('LAADS files for doy %s year %s have not '
+                                'changed. Skip.', doy, year)
+                    continue
+
+                # get the year + DOY string and download directory for this
+                # DOY
+                datestr = '{}{:03d}'.format(year, doy)
+                daydir = downloadDir(dloadbase, year, doy)
+
+                # get the downloaded Terra/Aqua CMG/CMA files for the
+                # current DOY, sorted by product, with a single pass through
+                # the directory
+                dayFiles = {product: [] for product in COMBINE_OPTIONS}
+                with os.scandir(daydir) as entries:
+                    for entry in entries:
+                        match = LADS_FILE_RE.match(entry.name)
+                        if match and match.group(2) == datestr \
+                                and entry.is_file():
+                            dayFiles[match.group(1)].append(
+                                daydir + '/' + entry.name)
+
+                # only one file is expected for each product.  if more than
+                # one was found which matched our date, then we have a
+                # problem.
+                for (product, fileList) in dayFiles.items():
+                    if len(fileList) > 1:
+                        logger.error('Multiple LAADS %s files found for doy '
+                                     '%s year %s', product, doy, year)
+                        return ERROR
+
+                # make sure at least one of the Aqua or Terra CMG files is
+                # present
+                if not dayFiles['MYD09CMG'] and not dayFiles['MOD09CMG']:
+                    logger.warning('No Aqua or Terra LAADS CMG data available '
+                                   'for doy %s year %s. Skipping this date.',
+                                   doy, year)
+                    continue
+
+                # make sure at least one of the Aqua or Terra CMA files is
+                # present
+                if not dayFiles['MYD09CMA'] and not dayFiles['MOD09CMA']:
+                    logger.warning('No Aqua or Terra LAADS CMA data available '
+                                   'for doy %s year %s. Skipping this date.',
+                                   doy, year)
+                    continue
+
+                # generate the command-line arguments and executable for
+                # combining the CMG and CMA products
+                cmd = ['combine_l8_aux_data']
+                for (product, option) in COMBINE_OPTIONS.items():
+                    if dayFiles[product]:
+                        cmd.extend([option, dayFiles[product][0]])
+                cmd.extend(['--output_dir', outputDir, '--verbose'])
+
+                # combine the products in the background so the remaining
+                # downloads keep going.  the days are independent of each
+                # other.  if too many DOYs are already waiting to be combined,
+                # then hold off on the downloads until one of them is done.
+                pending = [future for (future, _, _) in combines
+                           if not future.done()]
+                if len(pending) >= COMBINE_WORKERS + COMBINE_BACKLOG:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                names = [os.path.basename(fileList[0])
+                         for fileList in dayFiles.values() if fileList]
+                future = combinePool.submit(combineLads, cmd, year, doy,
+                                            daydir)
+                combines.append((future, names, validators))
+            # end for doy
+    finally:
+        # leaving the pool waits for the remaining combines, even if the
+        # downloads were interrupted by an error.  the validators of the
+        # downloaded files are only recorded once their DOY was combined, so
+        # the DOYs which failed to download or combine, or were skipped, are
+        # downloaded and combined again on the next run.  a failed combine
+        # doesn't stop the other days from being processed.
+        failed = 0
+        for (future, names, validators) in combines:
+            if not future.cancelled() and future.exception() is None \
+                    and future.result() == SUCCESS:
+                etags.update(validators)
             else:
-                msg = ('Multiple LAADS MYD09CMA files found for doy {} year {}'
-                       .format(doy, year))
-                logger.error(msg)
-                return ERROR
-
-        # make sure at least one of the Aqua or Terra CMG files is present
-        if not found_myd09cmg and not found_mod09cmg:
-            msg = ('No Aqua or Terra LAADS CMG data available for doy {} year '
-                   '{}. Skipping this date.'
-                   .format(doy, year))
-            logger.warning(msg)
-            continue
-
-        # make sure at least one of the Aqua or Terra CMA files is present
-        if not found_myd09cma and not found_mod09cma:
-            msg = ('No Aqua or Terra LAADS CMA data available for doy {} year '
-                   '{}. Skipping this date.'
-                   .format(doy, year))
-            logger.warning(msg)
-            continue
-
-        # generate the command-line arguments and executable for combining
-        # the CMG and CMA products
-        terra_cmg_cmdline = ''
-        if found_mod09cmg:
-            terra_cmg_cmdline = '--terra_cmg {}'.format(terra_cmg)
-
-        terra_cma_cmdline = ''
-        if found_mod09cma:
-            terra_cma_cmdline = '--terra_cma {}'.format(terra_cma)
-
-        aqua_cmg_cmdline = ''
-        if found_myd09cmg:
-            aqua_cmg_cmdline = '--aqua_cmg {}'.format(aqua_cmg)
-
-        aqua_cma_cmdline = ''
-        if found_myd09cma:
-            aqua_cma_cmdline = '--aqua_cma {}'.format(aqua_cma)
-
-        cmdstr = ('combine_l8_aux_data {} {} {} {} --output_dir {} --verbose'
-                  .format(terra_cmg_cmdline, terra_cma_cmdline,
-                          aqua_cmg_cmdline, aqua_cma_cmdline, outputDir))
-        msg = 'Executing {}'.format(cmdstr)
-        logger.info(msg)
-        try:
-            output = subprocess.run(cmdstr, check=True, shell=True)
-            logger.info(output)
-        except subprocess.CalledProcessError as e:
-            logger.error(e.output)
-            msg = ('Error running combine_l8_aux_data for year {}, DOY {}'
-                   .format(year, doy))
-            logger.error(msg)
-            continue
-    # end for doy
-    # remove the files downloaded to the temporary directory
-    msg = 'Removing downloaded files from {}'.format(dloaddir)
-    logger.info(msg)
-    if os.path.exists(dloaddir):
-        for myfile in os.listdir(dloaddir):
-            name = os.path.join(dloaddir, myfile)
-            os.remove(name)
+                failed += 1
+                for name in names:
+                    etags.pop(name, None)
+        if failed:
+            logger.warning('combine_l8_aux_data failed for %s of %s DOYs in '
+                           'year %s', failed, len(combines), year)
+        saveEtagCache(etagFile, etags)
+
+        # remove any files still left in the staging directory, such as for
+        # the DOYs which were skipped or failed to combine
+        logger.info('Removing downloaded files from %s', dloaddir)
+        if os.path.exists(dloaddir):
+            shutil.rmtree(dloaddir)
 
     return SUCCESS
 
@@ -474,8 +847,6 @@ def getLadsData(auxdir, year, today, token):
 #    date.
 ############################################################################
 def main():
-    logger = logging.getLogger(__name__)  # Get logger for the module.
-
     # get the command line arguments
     parser = OptionParser()
     parser.add_option('-s', '--start_year', type='int', dest='syear',
@@ -491,30 +862,41 @@ def main():
            .format(START_YEAR))
     parser.add_option('--quarterly', dest='quarterly', default=False,
                       action='store_true', help=msg)
+    parser.add_option('--workers', type='int', dest='workers',
+                      default=DOWNLOAD_WORKERS,
+                      help=('number of days of LAADS data to download '
+                            'concurrently (default is {})'
+                            .format(DOWNLOAD_WORKERS)))
 
     (options, args) = parser.parse_args()
     syear = options.syear           # starting year
     eyear = options.eyear           # ending year
     today = options.today           # process most recent year of data
     quarterly = options.quarterly   # process today back to START_YEAR
+    workers = options.workers       # number of concurrent downloads
 
     # check the arguments
     if (today is False) and (quarterly is False) and \
        (syear == 0 or eyear == 0):
-        msg = ('Invalid command line argument combination.  Type --help '
-               'for more information.')
-        logger.error(msg)
+        logger.error('Invalid command line argument combination.  Type --help '
+                     'for more information.')
         return ERROR
+    if workers < 1:
+        logger.error('--workers must be at least 1')
+        return ERROR
+
+    # size the LAADS connection pool to the number of download workers
+    mountLadsAdapter(SESSION, workers)
 
     # determine the auxiliary directory to store the data
     auxdir = os.environ.get('L8_AUX_DIR')
     if auxdir is None:
-        msg = 'L8_AUX_DIR environment variable not set... exiting'
-        logger.error(msg)
+        logger.error('L8_AUX_DIR environment variable not set... exiting')
         return ERROR
 
     # Get the application token for the LAADS https interface. for ESPA
     # systems, pull the token from the config file.
+    token = None
     if TOKEN is None:
         # ESPA Processing Environment
         # Read ~/.usgs/espa/processing.conf to get the URL for the ESPA API.
@@ -538,40 +920,39 @@ def main():
                      'token provided for accessing the LAADS data. ')
         return ERROR
 
+    # the date the run started is used for all the years processed
+    now = datetime.datetime.now()
+    ctx = RunCtx(token=token, current_year=now.year,
+                 today_doy=now.timetuple().tm_yday, today=today,
+                 workers=workers)
+
     # if processing today then process the current year.  if the current
     # DOY is within the first month, then process the previous year as well
     # to make sure we have all the recently available data processed.
     if today:
-        msg = 'Processing LAADS data up to the most recent year and DOY.'
-        logger.info(msg)
-        now = datetime.datetime.now()
-        day_of_year = now.timetuple().tm_yday
-        eyear = now.year
-        if day_of_year <= 31:
+        logger.info('Processing LAADS data up to the most recent year and '
+                    'DOY.')
+        eyear = ctx.current_year
+        if ctx.today_doy <= 31:
             syear = eyear - 1
         else:
             syear = eyear
 
     elif quarterly:
-        msg = 'Processing LAADS data back to {}'.format(START_YEAR)
-        logger.info(msg)
-        eyear = now.year
+        logger.info('Processing LAADS data back to %s', START_YEAR)
+        eyear = ctx.current_year
         syear = START_YEAR
 
-    msg = 'Processing LAADS data for {} - {}'.format(syear, eyear)
-    logger.info(msg)
+    logger.info('Processing LAADS data for %s - %s', syear, eyear)
     for yr in range(eyear, syear-1, -1):
-        msg = 'Processing year: {}'.format(yr)
-        logger.info(msg)
-        status = getLadsData(auxdir, yr, today, token)
+        logger.info('Processing year: %s', yr)
+        status = getLadsData(auxdir, yr, ctx)
         if status == ERROR:
-            msg = ('Problems occurred while processing LAADS data for year {}'
-                   .format(yr))
-            logger.error(msg)
+            logger.error('Problems occurred while processing LAADS data for '
+                         'year %s', yr)
             return ERROR
 
-    msg = 'LAADS processing complete.'
-    logger.info(msg)
+    logger.info('LAADS processing complete.')
     return SUCCESS
 
 